@@ -1,18 +1,55 @@
 import os
+if os.getenv("USE_GEVENT") == "1":
+    # Self-hosted gunicorn/gevent only; must run before any other import
+    from gevent import monkey
+    monkey.patch_all()
 import logging
-from logging.handlers import RotatingFileHandler
-from flask import Flask, request
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import SimpleQueue
+from flask import Flask, Request, request
+from flask.json.provider import JSONProvider
+from werkzeug.exceptions import RequestEntityTooLarge
 from telegram import Update
-from telegram.ext import Application, CommandHandler
+from telegram.ext import AIORateLimiter, Application, CommandHandler
 import asyncio
-from supabase import create_client
+import atexit
+import concurrent.futures
+import threading
+from supabase import acreate_client, ClientOptions, PostgrestAPIError
+from gotrue import AsyncMemoryStorage
 import random
 import requests
+import httpx
 import hmac
 import hashlib
-import json
+import orjson
+from types import MappingProxyType
+from decimal import Decimal
+from cachetools import TTLCache
+from money import SCALE, to_units, format_units
+
+class OrjsonProvider(JSONProvider):
+    # Any request.get_json()/jsonify use goes through orjson too
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+class CappedRequest(Request):
+    # Werkzeug enforces this while reading the body, so chunked uploads without a
+    # Content-Length are bounded too (Flask 2.3's own property is read-only config).
+    # A chunked body is cut off rather than rejected, hence the extra byte: a body
+    # longer than MAX_TATUM_PAYLOAD always shows up as one.
+    @property
+    def max_content_length(self):
+        if self.endpoint == 'tatum_webhook':
+            return MAX_TATUM_PAYLOAD + 1
+        return super().max_content_length
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+app.request_class = CappedRequest
 
 # Setup logging
 logging.basicConfig(
@@ -21,15 +58,51 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 log_file = "/tmp/app.log"
-handler = RotatingFileHandler(log_file, maxBytes=1000000, backupCount=1)
+# Console output comes from basicConfig's root handler; only add the file here
+handler = RotatingFileHandler(log_file, maxBytes=1_000_000, backupCount=1, delay=True)
 handler.setLevel(logging.INFO)
 formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 handler.setFormatter(formatter)
-logger.addHandler(handler)
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
+# File writes happen on the listener's thread so a slow disk never blocks a request
+log_queue = SimpleQueue()
+log_listener = QueueListener(log_queue, handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+logger.addHandler(QueueHandler(log_queue))
+
+# Supported cryptocurrencies
+SUPPORTED_CRYPTOS = ("SOL", "LTC", "BTC", "ETH")
+VALID_CRYPTOS = frozenset(SUPPORTED_CRYPTOS)
+CHAIN_MAP = MappingProxyType({
+    "SOL": "solana",
+    "ETH": "ethereum",
+    "LTC": "litecoin",
+    "BTC": "bitcoin"
+})
+CURRENCY_MAP = MappingProxyType({
+    "SOLANA": "SOL",
+    "ETHEREUM": "ETH",
+    "LITECOIN": "LTC",
+    "BITCOIN": "BTC"
+})
+CONFIRMATION_THRESHOLDS = MappingProxyType({
+    "SOL": 1,
+    "ETH": 12,
+    "LTC": 6,
+    "BTC": 6
+})
+MAX_TATUM_PAYLOAD = 16_384
+# Bounds of the integer confirmations argument and of a bigint unit amount
+MAX_CONFIRMATIONS = 2 ** 31 - 1
+MAX_DEPOSIT_UNITS = 2 ** 63 - 1
+# OS entropy for bets, so rolls can't be predicted from earlier outcomes
+DICE_RNG = random.SystemRandom()
+
+# Tatum API endpoints
+TATUM_BASE_URL = "https://api.tatum.io/v3"
+SUBSCRIPTION_URL = f"{TATUM_BASE_URL}/subscription"
+WALLET_URL = MappingProxyType({chain: f"{TATUM_BASE_URL}/{chain}/wallet" for chain in CHAIN_MAP.values()})
+ADDRESS_URL_TEMPLATE = TATUM_BASE_URL + "/{chain}/address/{xpub}/{index}"
 
 # Environment variables
 API_TOKEN = os.getenv("API_TOKEN")
@@ -37,50 +110,172 @@ SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 TATUM_API_KEY = os.getenv("TATUM_API_KEY")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# HD wallet xpubs for ETH/LTC/BTC, generated offline by the operator who keeps the
+# mnemonic; never created here, since the keys of a runtime-created wallet are lost
+XPUBS = MappingProxyType({crypto: os.getenv(f"{crypto}_XPUB") for crypto in ("ETH", "LTC", "BTC")})
 
 if not all([API_TOKEN, SUPABASE_URL, SUPABASE_KEY, TATUM_API_KEY, WEBHOOK_URL]):
     logger.error("Missing required environment variables")
     raise ValueError("Missing required environment variables")
 
+# Background event loop shared by all webhook requests
+LOOP = asyncio.new_event_loop()
+threading.Thread(target=LOOP.run_forever, daemon=True).start()
+
+def run_async(coro, timeout=25):
+    fut = asyncio.run_coroutine_threadsafe(coro, LOOP)
+    try:
+        return fut.result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        # Don't leave the coroutine running on LOOP after the caller has given up on it
+        fut.cancel()
+        raise
+
+# Strong references to fire-and-forget tasks so they aren't garbage collected
+BACKGROUND_TASKS = set()
+
+def spawn(coro):
+    # Must be called from code already running on LOOP
+    task = LOOP.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
 # Connect to Supabase
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-response = supabase.table("users").select("user_id").limit(1).execute()
-logger.info("Successfully connected to Supabase")
-logger.info("Assuming transactions table exists (manually created)")
+SUPABASE_TIMEOUT = httpx.Timeout(10.0, connect=3.0)
+
+async def create_supabase_client():
+    client = await acreate_client(
+        SUPABASE_URL,
+        SUPABASE_KEY,
+        options=ClientOptions(
+            storage=AsyncMemoryStorage(),
+            postgrest_client_timeout=SUPABASE_TIMEOUT
+        )
+    )
+    # Replace PostgREST's default HTTP client with a bounded keep-alive pool
+    default_session = client.postgrest.session
+    client.postgrest.session = httpx.AsyncClient(
+        base_url=default_session.base_url,
+        headers=default_session.headers,
+        timeout=SUPABASE_TIMEOUT,
+        follow_redirects=True,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=10, max_connections=20)
+    )
+    await default_session.aclose()
+    return client
+
+# Single async client per process, bound to LOOP; never create another
+supabase = run_async(create_supabase_client())
+
+# (user_id, crypto) -> address; only addresses read back from the DB, which never change once assigned
+DEPOSIT_CACHE = TTLCache(maxsize=10_000, ttl=600)
+# user_id -> users row; short TTL, popped on every balance/address write
+USER_CACHE = TTLCache(maxsize=10_000, ttl=5)
+# Every handler reads users through this one projection so cache entries are shared
+USER_COLUMNS = "user_id,balances,deposit_addresses"
+
+# Shared async HTTP client for Tatum (keep-alive pool, lives on LOOP)
+TATUM_CLIENT = httpx.AsyncClient(
+    headers={
+        "x-api-key": TATUM_API_KEY,
+        "Content-Type": "application/json"
+    },
+    # Fail fast on an unreachable or hung Tatum instead of pinning a worker
+    timeout=httpx.Timeout(10.0, connect=3.0),
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        retries=3
+    )
+)
 
 # Initialize Telegram bot
-application = Application.builder().token(API_TOKEN).build()
+# All outbound calls (handler replies and deposit notifications) are throttled below
+# Telegram's ~30 msg/s global limit, and RetryAfter responses are retried
+telegram_app = (
+    Application.builder()
+    .token(API_TOKEN)
+    .rate_limiter(AIORateLimiter(overall_max_rate=29, max_retries=3))
+    # Sized like TATUM_CLIENT's pool; a burst waits for a free connection instead of failing
+    .connection_pool_size(100)
+    .pool_timeout(5.0)
+    .build()
+)
 logger.info("Telegram bot initialized successfully")
 
+run_async(telegram_app.initialize())
+logger.info("Telegram bot application initialized on background loop")
+
+def shutdown_loop():
+    # Close PTB's, Tatum's and PostgREST's connection pools on the loop that owns them
+    try:
+        run_async(telegram_app.shutdown(), timeout=5)
+        run_async(TATUM_CLIENT.aclose(), timeout=5)
+        run_async(supabase.postgrest.session.aclose(), timeout=5)
+    except Exception as e:
+        logger.warning("Error shutting down background loop: %s", e)
+    LOOP.call_soon_threadsafe(LOOP.stop)
+
+atexit.register(shutdown_loop)
+
+# Tatum 5xx / transport-error retries (connect failures are also retried by the transport)
+TATUM_MAX_ATTEMPTS = 3
+TATUM_BACKOFF_FACTOR = 0.3
+TATUM_RETRY_STATUSES = frozenset((500, 502, 503, 504))
+
+# Tatum subscription retries, driven by deposit_addresses.subscribed
+SUBSCRIPTION_RETRY_DELAY = 30
+SUBSCRIPTION_MAX_ATTEMPTS = 5
+SUBSCRIPTION_RETRY_BATCH = 50
+
+# Tatum deposit micro-batching
+DEPOSIT_BATCH_WINDOW = 0.05
+DEPOSIT_BATCH_SIZE = 64
+
 # Helper functions
-def verify_tatum_signature(payload, signature):
+def verify_tatum_signature(raw_body, signature):
     try:
         computed_signature = hmac.new(
             TATUM_API_KEY.encode('utf-8'),
-            json.dumps(payload, separators=(',', ':')).encode('utf-8'),
+            raw_body,
             hashlib.sha256
-        ).hexdigest()
-        return hmac.compare_digest(computed_signature, signature)
+        ).digest()
+        try:
+            provided_signature = bytes.fromhex(signature)
+        except ValueError:
+            return False
+        return len(provided_signature) == len(computed_signature) and hmac.compare_digest(computed_signature, provided_signature)
     except Exception as e:
-        logger.error(f"Error verifying Tatum signature: {str(e)}", exc_info=True)
+        logger.error("Error verifying Tatum signature: %s", e, exc_info=True)
         return False
 
-def create_tatum_subscription(address, crypto):
+async def tatum_request(method, url, **kwargs):
+    # Returns the successful response, or None once retries are exhausted
+    for attempt in range(1, TATUM_MAX_ATTEMPTS + 1):
+        try:
+            response = await TATUM_CLIENT.request(method, url, **kwargs)
+            if response.status_code not in TATUM_RETRY_STATUSES:
+                response.raise_for_status()
+                return response
+            logger.warning("Tatum %s %s returned %s (attempt %s)", method, url, response.status_code, attempt)
+        except httpx.TransportError as e:
+            logger.warning("Tatum %s %s failed: %s (attempt %s)", method, url, e, attempt)
+        except httpx.HTTPStatusError as e:
+            logger.error("Tatum %s %s returned %s: %s", method, url, e.response.status_code, e.response.text)
+            return None
+        if attempt < TATUM_MAX_ATTEMPTS:
+            await asyncio.sleep(TATUM_BACKOFF_FACTOR * 2 ** (attempt - 1))
+    logger.error("Giving up on Tatum %s %s after %s attempts", method, url, TATUM_MAX_ATTEMPTS)
+    return None
+
+async def create_tatum_subscription(address, crypto):
     try:
-        chain_map = {
-            "SOL": "solana",
-            "ETH": "ethereum",
-            "LTC": "litecoin",
-            "BTC": "bitcoin"
-        }
-        chain = chain_map.get(crypto)
+        chain = CHAIN_MAP.get(crypto)
         if not chain:
-            logger.error(f"Unsupported crypto: {crypto}")
+            logger.error("Unsupported crypto: %s", crypto)
             return False
-        headers = {
-            "x-api-key": TATUM_API_KEY,
-            "Content-Type": "application/json"
-        }
         payload = {
             "type": "ADDRESS_TRANSACTION",
             "attr": {
@@ -89,109 +284,178 @@ def create_tatum_subscription(address, crypto):
                 "url": WEBHOOK_URL
             }
         }
-        response = requests.post("https://api.tatum.io/v3/subscription", json=payload, headers=headers)
-        response.raise_for_status()
-        logger.info(f"Created Tatum subscription for {crypto} address: {address}")
+        response = await tatum_request("POST", SUBSCRIPTION_URL, content=orjson.dumps(payload))
+        if response is None:
+            return False
+        logger.info("Created Tatum subscription for %s address: %s", crypto, address)
         return True
     except Exception as e:
-        logger.error(f"Failed to create Tatum subscription: {str(e)}", exc_info=True)
+        logger.error("Failed to create Tatum subscription: %s", e, exc_info=True)
         return False
 
-def generate_deposit_address(crypto):
+async def subscribe_address(address, crypto, attempts):
+    # Records the outcome on the deposit_addresses row; returns whether it is subscribed
+    if await create_tatum_subscription(address, crypto):
+        await supabase.table("deposit_addresses").update({"subscribed": True}).eq("address", address).execute()
+        return True
+    attempts += 1
+    # Guarded on subscribed so a concurrent success from another instance is never undone
+    await supabase.table("deposit_addresses").update(
+        {"subscribe_attempts": attempts}
+    ).eq("address", address).eq("subscribed", False).execute()
+    if attempts >= SUBSCRIPTION_MAX_ATTEMPTS:
+        logger.error("Giving up on Tatum subscription for %s address %s after %s attempts", crypto, address, attempts)
+    return False
+
+async def subscription_retry_worker():
+    # Polls the table rather than an in-memory queue, so pending retries survive restarts
+    while True:
+        await asyncio.sleep(SUBSCRIPTION_RETRY_DELAY)
+        try:
+            response = await supabase.table("deposit_addresses").select(
+                "address,crypto,subscribe_attempts"
+            ).eq("subscribed", False).lt(
+                "subscribe_attempts", SUBSCRIPTION_MAX_ATTEMPTS
+            ).limit(SUBSCRIPTION_RETRY_BATCH).execute()
+            for row in response.data:
+                await subscribe_address(row['address'], row['crypto'], row['subscribe_attempts'])
+        except Exception as e:
+            logger.error("Tatum subscription retry pass failed: %s", e, exc_info=True)
+
+async def deposit_batch_worker(queue):
+    while True:
+        batch = [await queue.get()]
+        # Let concurrent webhooks pile up briefly, then credit them together
+        await asyncio.sleep(DEPOSIT_BATCH_WINDOW)
+        while len(batch) < DEPOSIT_BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+        try:
+            response = await supabase.rpc("batch_credit_deposits", {
+                "p_events": [event for event, _ in batch]
+            }).execute()
+            rows = {row['idx']: row for row in response.data}
+            for idx, (event, future) in enumerate(batch, start=1):
+                if future.done():
+                    continue
+                row = rows.get(idx)
+                if row and row['error']:
+                    # Only this event failed; the rest of the batch was credited
+                    logger.error("Failed to credit deposit %s: %s", event['tx_id'], row['error'])
+                    future.set_exception(RuntimeError(row['error']))
+                else:
+                    future.set_result(row)
+        except Exception as e:
+            logger.error("Failed to credit batch of %s deposits: %s", len(batch), e, exc_info=True)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+async def start_background_workers():
+    spawn(subscription_retry_worker())
+    # Queues must be created on LOOP (Python 3.9 binds them at construction)
+    deposit_queue = asyncio.Queue()
+    spawn(deposit_batch_worker(deposit_queue))
+    return deposit_queue
+
+async def reserve_address_index(crypto):
+    xpub = XPUBS.get(crypto)
+    if not xpub:
+        logger.error("%s_XPUB is not configured; not deriving %s addresses", crypto, crypto)
+        return None
+    response = await supabase.rpc("next_address_index", {"p_crypto": crypto}).execute()
+    if not response.data:
+        # First address for this crypto: register the operator's wallet once
+        await supabase.table("app_wallets").upsert(
+            {"crypto": crypto, "xpub": xpub},
+            on_conflict="crypto",
+            ignore_duplicates=True
+        ).execute()
+        logger.info("Registered shared %s wallet", crypto)
+        response = await supabase.rpc("next_address_index", {"p_crypto": crypto}).execute()
+    wallet = response.data[0] if response.data else None
+    if wallet and wallet['xpub'] != xpub:
+        logger.error("app_wallets holds a different %s xpub than %s_XPUB; not deriving addresses", crypto, crypto)
+        return None
+    return wallet
+
+async def generate_deposit_address(crypto):
     try:
-        chain_map = {
-            "SOL": "solana",
-            "ETH": "ethereum",
-            "LTC": "litecoin",
-            "BTC": "bitcoin"
-        }
-        chain = chain_map.get(crypto)
+        chain = CHAIN_MAP.get(crypto)
         if not chain:
-            logger.error(f"Unsupported crypto: {crypto}")
+            logger.error("Unsupported crypto: %s", crypto)
             return None
-        headers = {
-            "x-api-key": TATUM_API_KEY,
-            "Content-Type": "application/json"
-        }
         if chain == "solana":
-            url = f"https://api.tatum.io/v3/{chain}/wallet"
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            wallet_data = response.json()
-            address = wallet_data.get("address")
-            if not address:
-                logger.error(f"No address found for {crypto}")
+            # Solana has no xpub derivation; each wallet call yields a fresh address
+            address_url = WALLET_URL[chain]
+        else:
+            wallet = await reserve_address_index(crypto)
+            if not wallet:
                 return None
-            create_tatum_subscription(address, crypto)
-            return address
-        url = f"https://api.tatum.io/v3/{chain}/wallet"
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        wallet_data = response.json()
-        xpub = wallet_data.get("xpub")
-        if not xpub:
-            logger.error(f"No xpub found for {crypto}")
+            address_url = ADDRESS_URL_TEMPLATE.format(chain=chain, xpub=wallet['xpub'], index=wallet['address_index'])
+        response = await tatum_request("GET", address_url)
+        if response is None:
+            return None
+        address = orjson.loads(response.content).get("address")
+        if not isinstance(address, str) or not address:
+            logger.error("No address found for %s", crypto)
             return None
-        address_url = f"https://api.tatum.io/v3/{chain}/address/{xpub}/0"
-        address_response = requests.get(address_url, headers=headers)
-        address_response.raise_for_status()
-        address_data = address_response.json()
-        address = address_data["address"]
-        create_tatum_subscription(address, crypto)
         return address
     except Exception as e:
-        logger.error(f"Failed to generate deposit address: {str(e)}", exc_info=True)
+        logger.error("Failed to generate deposit address: %s", e, exc_info=True)
         return None
 
+async def get_user(user_id):
+    # Only touched from LOOP, so no lock is needed around the cache
+    user = USER_CACHE.get(user_id)
+    if user is None:
+        response = await supabase.table("users").select(USER_COLUMNS).eq("user_id", user_id).execute()
+        user = response.data[0] if response.data else None
+        if user:
+            USER_CACHE[user_id] = user
+    return user
+
 def process_withdrawal(crypto, amount, destination_address):
     try:
-        chain_map = {
-            "SOL": "solana",
-            "ETH": "ethereum",
-            "LTC": "litecoin",
-            "BTC": "bitcoin"
-        }
-        chain = chain_map.get(crypto)
+        chain = CHAIN_MAP.get(crypto)
         if not chain:
-            logger.error(f"Unsupported cryptocurrency: {crypto}")
+            logger.error("Unsupported cryptocurrency: %s", crypto)
             return False, "Unsupported cryptocurrency"
-        logger.info(f"Simulated withdrawal: {amount} {crypto} to {destination_address}")
+        logger.info("Simulated withdrawal: %s %s to %s", amount, crypto, destination_address)
         return True, "Withdrawal simulated successfully (testnet)"
     except Exception as e:
-        logger.error(f"Failed to process withdrawal: {str(e)}", exc_info=True)
+        logger.error("Failed to process withdrawal: %s", e, exc_info=True)
         return False, str(e)
 
 # Command handlers
 async def start(update, context):
     try:
         user_id = update.effective_user.id
-        logger.info(f"Received /start from user {user_id}")
-        response = supabase.table("users").select("*").eq("user_id", user_id).execute()
-        user = response.data[0] if response.data else None
-        if not user:
-            supabase.table("users").insert({
-                "user_id": user_id,
-                "balances": {
-                    "SOL": 10.0,
-                    "LTC": 10.0,
-                    "BTC": 0.001,
-                    "ETH": 10.0
-                },
-                "deposit_addresses": {}
-            }).execute()
+        logger.info("Received /start from user %s", user_id)
+        # Insert-if-missing in one round-trip; only a newly inserted row is returned
+        response = await supabase.table("users").upsert({
+            "user_id": user_id,
+            "balances": {
+                "SOL": 10 * SCALE["SOL"],
+                "LTC": 10 * SCALE["LTC"],
+                "BTC": SCALE["BTC"] // 1000,
+                "ETH": 10 * SCALE["ETH"]
+            },
+            "deposit_addresses": {}
+        }, on_conflict="user_id", ignore_duplicates=True).execute()
+        if response.data:
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text="Welcome to the Casino Bot! Registered with 10 units of SOL, LTC, ETH, and 0.001 BTC. Use /help for commands."
             )
-            logger.info(f"Registered new user: {user_id}")
+            logger.info("Registered new user: %s", user_id)
         else:
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text="Welcome back! Use /help for commands."
             )
-            logger.info(f"User {user_id} returned")
+            logger.info("User %s returned", user_id)
     except Exception as e:
-        logger.error(f"Error in /start: {str(e)}", exc_info=True)
+        logger.error("Error in /start: %s", e, exc_info=True)
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text="Error accessing database. Try again later."
@@ -204,13 +468,12 @@ async def help_command(update, context):
             text="Commands:\n/start - Register/welcome\n/help - Show this\n/roll <crypto> <amount> - Bet (e.g., /roll SOL 1)\n/deposit <crypto> - Get address (e.g., /deposit SOL)\n/withdraw <crypto> <amount> <address> - Withdraw (e.g., /withdraw SOL 0.1 <address>)\n/balance - Check balances"
         )
     except Exception as e:
-        logger.error(f"Error in /help: {str(e)}", exc_info=True)
+        logger.error("Error in /help: %s", e, exc_info=True)
 
 async def balance(update, context):
     try:
         user_id = update.effective_user.id
-        response = supabase.table("users").select("balances").eq("user_id", user_id).execute()
-        user = response.data[0] if response.data else None
+        user = await get_user(user_id)
         if not user:
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
@@ -218,83 +481,73 @@ async def balance(update, context):
             )
             return
         balances = user['balances']
-        balance_text = "Your balances:\n" + "\n".join(f"{crypto}: {amount}" for crypto, amount in balances.items())
+        lines = [f"{crypto}: {format_units(crypto, balances.get(crypto, 0))}" for crypto in SUPPORTED_CRYPTOS]
+        balance_text = "Your balances:\n" + "\n".join(lines)
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text=balance_text
         )
     except Exception as e:
-        logger.error(f"Error in /balance: {str(e)}", exc_info=True)
+        logger.error("Error in /balance: %s", e, exc_info=True)
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text="Error accessing database. Try again later."
         )
 
 async def roll(update, context):
+    chat_id = update.effective_chat.id
     try:
         user_id = update.effective_user.id
         args = context.args
+        err = None
         if len(args) != 2:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="Usage: /roll <crypto> <amount>\nExample: /roll SOL 0.1"
-            )
-            return
-        crypto, amount_str = args[0].upper(), args[1]
-        valid_cryptos = ['SOL', 'LTC', 'BTC', 'ETH']
-        if crypto not in valid_cryptos:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"Invalid crypto. Use: {', '.join(valid_cryptos)}"
-            )
-            return
-        try:
-            bet_amount = float(amount_str)
-            if bet_amount <= 0:
-                raise ValueError
-        except ValueError:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="Amount must be positive (e.g., 0.1)"
-            )
-            return
-        response = supabase.table("users").select("balances").eq("user_id", user_id).execute()
-        user = response.data[0] if response.data else None
-        if not user:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="Not registered. Use /start."
-            )
-            return
-        current_balance = user['balances'].get(crypto, 0.0)
-        if current_balance < bet_amount:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"Insufficient {crypto} balance: {current_balance}"
-            )
+            err = "Usage: /roll <crypto> <amount>\nExample: /roll SOL 0.1"
+        else:
+            crypto, amount_str = args[0].upper(), args[1]
+            if crypto not in VALID_CRYPTOS:
+                err = f"Invalid crypto. Use: {', '.join(SUPPORTED_CRYPTOS)}"
+            else:
+                try:
+                    bet_units = to_units(crypto, amount_str)
+                    if bet_units <= 0:
+                        raise ValueError
+                except ValueError:
+                    err = "Amount must be positive (e.g., 0.1)"
+        if err:
+            await context.bot.send_message(chat_id=chat_id, text=err)
             return
-        dice1 = random.randint(1, 6)
-        dice2 = random.randint(1, 6)
+        # One draw covers both dice: 36 equally likely outcomes
+        n = DICE_RNG.randrange(36)
+        dice1, dice2 = n // 6 + 1, n % 6 + 1
         total = dice1 + dice2
         if total >= 7:
-            winnings = bet_amount * 2
-            new_balance = current_balance + bet_amount
-            result = f"🎲 Rolled {dice1} + {dice2} = {total}\nWon! +{winnings} {crypto}"
+            delta = bet_units
+            result = f"🎲 Rolled {dice1} + {dice2} = {total}\nWon! +{format_units(crypto, bet_units * 2)} {crypto}"
         else:
-            new_balance = current_balance - bet_amount
-            result = f"🎲 Rolled {dice1} + {dice2} = {total}\nLost! -{bet_amount} {crypto}"
-        updated_balances = user['balances'].copy()
-        updated_balances[crypto] = new_balance
-        supabase.table("users").update({"balances": updated_balances}).eq("user_id", user_id).execute()
-        logger.info(f"User {user_id} rolled, new {crypto} balance: {new_balance}")
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=f"{result}\nNew {crypto} balance: {new_balance}"
-        )
+            delta = -bet_units
+            result = f"🎲 Rolled {dice1} + {dice2} = {total}\nLost! -{format_units(crypto, bet_units)} {crypto}"
+        response = await supabase.rpc("roll_dice", {
+            "p_user_id": user_id,
+            "p_crypto": crypto,
+            "p_bet": bet_units,
+            "p_delta": delta
+        }).execute()
+        USER_CACHE.pop(user_id, None)
+        if response.data:
+            new_balance = format_units(crypto, response.data[0]['new_balances'][crypto])
+            logger.info("User %s rolled, new %s balance: %s", user_id, crypto, new_balance)
+            text = f"{result}\nNew {crypto} balance: {new_balance}"
+        else:
+            user = await get_user(user_id)
+            if not user:
+                text = "Not registered. Use /start."
+            else:
+                text = f"Insufficient {crypto} balance: {format_units(crypto, user['balances'].get(crypto, 0))}"
+        await context.bot.send_message(chat_id=chat_id, text=text)
     except Exception as e:
-        logger.error(f"Error in /roll: {str(e)}", exc_info=True)
+        logger.error("Error in /roll: %s", e, exc_info=True)
         await context.bot.send_message(
-            chat_id=update.effective_chat.id,
+            chat_id=chat_id,
             text="Error accessing database. Try again later."
         )
 
@@ -309,41 +562,51 @@ async def deposit(update, context):
             )
             return
         crypto = args[0].upper()
-        valid_cryptos = ['SOL', 'LTC', 'BTC', 'ETH']
-        if crypto not in valid_cryptos:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"Invalid crypto. Use: {', '.join(valid_cryptos)}"
-            )
-            return
-        response = supabase.table("users").select("deposit_addresses").eq("user_id", user_id).execute()
-        user = response.data[0] if response.data else None
-        if not user:
+        if crypto not in VALID_CRYPTOS:
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
-                text="Not registered. Use /start."
+                text=f"Invalid crypto. Use: {', '.join(SUPPORTED_CRYPTOS)}"
             )
             return
-        deposit_addresses = user['deposit_addresses'] or {}
-        if crypto in deposit_addresses:
-            address = deposit_addresses[crypto]
-        else:
-            address = generate_deposit_address(crypto)
+        address = DEPOSIT_CACHE.get((user_id, crypto))
+        if address is None:
+            # Re-read rather than trust USER_CACHE: another worker may have assigned one meanwhile
+            USER_CACHE.pop(user_id, None)
+            user = await get_user(user_id)
+            if not user:
+                await context.bot.send_message(
+                    chat_id=update.effective_chat.id,
+                    text="Not registered. Use /start."
+                )
+                return
+            address = (user['deposit_addresses'] or {}).get(crypto)
+        if address is None:
+            address = await generate_deposit_address(crypto)
             if not address:
                 await context.bot.send_message(
                     chat_id=update.effective_chat.id,
                     text=f"Failed to generate {crypto} address."
                 )
                 return
-            deposit_addresses[crypto] = address
-            supabase.table("users").update({"deposit_addresses": deposit_addresses}).eq("user_id", user_id).execute()
-            logger.info(f"Generated deposit address for user {user_id}: {crypto} - {address}")
+            # Server-side || merge, so keys added by other workers are never overwritten
+            await supabase.rpc("save_deposit_addresses", {
+                "p_rows": [{"user_id": user_id, "crypto": crypto, "address": address}]
+            }).execute()
+            USER_CACHE.pop(user_id, None)
+            logger.info("Generated deposit address for user %s: %s - %s", user_id, crypto, address)
+            # Subscribe before replying; on Vercel nothing may run once the response is sent.
+            # A failure stays recorded on the row and subscription_retry_worker picks it up.
+            try:
+                await subscribe_address(address, crypto, 0)
+            except Exception as e:
+                logger.error("Failed to subscribe %s address %s: %s", crypto, address, e, exc_info=True)
+        DEPOSIT_CACHE[(user_id, crypto)] = address
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text=f"Your {crypto} deposit address (testnet):\n{address}\nSend {crypto} to deposit."
         )
     except Exception as e:
-        logger.error(f"Error in /deposit: {str(e)}", exc_info=True)
+        logger.error("Error in /deposit: %s", e, exc_info=True)
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text="Error generating deposit address. Try again later."
@@ -360,16 +623,15 @@ async def withdraw(update, context):
             )
             return
         crypto, amount_str, destination_address = args[0].upper(), args[1], args[2]
-        valid_cryptos = ['SOL', 'LTC', 'BTC', 'ETH']
-        if crypto not in valid_cryptos:
+        if crypto not in VALID_CRYPTOS:
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
-                text=f"Invalid crypto. Use: {', '.join(valid_cryptos)}"
+                text=f"Invalid crypto. Use: {', '.join(SUPPORTED_CRYPTOS)}"
             )
             return
         try:
-            amount = float(amount_str)
-            if amount <= 0:
+            units = to_units(crypto, amount_str)
+            if units <= 0:
                 raise ValueError
         except ValueError:
             await context.bot.send_message(
@@ -377,153 +639,190 @@ async def withdraw(update, context):
                 text="Amount must be positive (e.g., 0.1)"
             )
             return
-        response = supabase.table("users").select("balances").eq("user_id", user_id).execute()
-        user = response.data[0] if response.data else None
-        if not user:
+        try:
+            response = await supabase.rpc("apply_balance_delta", {
+                "p_user_id": user_id,
+                "p_crypto": crypto,
+                "p_delta": -units
+            }).execute()
+            USER_CACHE.pop(user_id, None)
+        except PostgrestAPIError as e:
+            if e.message != "insufficient_funds":
+                raise
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
-                text="Not registered. Use /start."
+                text=f"Insufficient {crypto} balance: {format_units(crypto, Decimal(e.details))}"
             )
             return
-        current_balance = user['balances'].get(crypto, 0.0)
-        if current_balance < amount:
+        if not response.data:
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
-                text=f"Insufficient {crypto} balance: {current_balance}"
+                text="Not registered. Use /start."
             )
             return
+        new_balance = format_units(crypto, response.data[0]['new_balances'][crypto])
+        amount = format_units(crypto, units)
         success, message = process_withdrawal(crypto, amount, destination_address)
         if not success:
+            # Refund the debited amount
+            await supabase.rpc("apply_balance_delta", {
+                "p_user_id": user_id,
+                "p_crypto": crypto,
+                "p_delta": units
+            }).execute()
+            USER_CACHE.pop(user_id, None)
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text=f"Withdrawal failed: {message}"
             )
             return
-        new_balance = current_balance - amount
-        updated_balances = user['balances'].copy()
-        updated_balances[crypto] = new_balance
-        supabase.table("users").update({"balances": updated_balances}).eq("user_id", user_id).execute()
-        logger.info(f"User {user_id} withdrew {amount} {crypto}, new balance: {new_balance}")
+        logger.info("User %s withdrew %s %s, new balance: %s", user_id, amount, crypto, new_balance)
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text=f"Withdrew {amount} {crypto} to {destination_address}\nNew {crypto} balance: {new_balance}"
         )
     except Exception as e:
-        logger.error(f"Error in /withdraw: {str(e)}", exc_info=True)
+        logger.error("Error in /withdraw: %s", e, exc_info=True)
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text="Error processing withdrawal. Try again later."
         )
 
+async def process_telegram_update(update_data):
+    # Parse and dispatch on LOOP, against the long-lived initialized Application
+    update = Update.de_json(update_data, telegram_app.bot)
+    if not update:
+        return False
+    await telegram_app.process_update(update)
+    return True
+
+async def credit_deposit(address, crypto, amount, units, tx_id, confirmations):
+    # Queued for deposit_batch_worker; resolves once the batch has been credited
+    future = LOOP.create_future()
+    DEPOSIT_QUEUE.put_nowait(({
+        "address": address,
+        "crypto": crypto,
+        "amount": amount,
+        "units": units,
+        "tx_id": tx_id,
+        "confirmations": confirmations
+    }, future))
+    row = await future
+    if not row:
+        logger.warning("No user found for address: %s", address)
+        return {"status": "error", "message": "User not found"}, 404
+    if not row['credited']:
+        logger.info("Transaction %s already processed", tx_id)
+        return {"status": "success", "message": "Transaction already processed"}, 200
+    USER_CACHE.pop(row['user_id'], None)
+    logger.info("Deposited %s %s for user %s (tx: %s)", amount, crypto, row['user_id'], tx_id)
+    await telegram_app.bot.send_message(
+        chat_id=row['user_id'],
+        text=f"Deposit confirmed: {amount} {crypto} received!\nNew {crypto} balance: {format_units(crypto, row['new_balances'][crypto])}"
+    )
+    return {"status": "success"}, 200
+
 # Routes
+def json_response(body, status=200):
+    return app.response_class(orjson.dumps(body), status=status, mimetype="application/json")
+
+# Static body and headers; nothing per-request is ever set on it
+HEALTH_RESPONSE = json_response({"status": "healthy"}, 200)
+
 @app.route('/health')
 def health():
-    return {"status": "healthy"}, 200
+    # /health?deep=1 also checks that Supabase answers; plain probes stay free
+    if not request.args.get('deep'):
+        return HEALTH_RESPONSE
+    try:
+        run_async(supabase.table("users").select("user_id").limit(1).execute(), timeout=5)
+        return json_response({"status": "healthy", "supabase": "ok"}, 200)
+    except Exception as e:
+        logger.error("Supabase health check failed: %s", e, exc_info=True)
+        return json_response({"status": "unhealthy", "supabase": "unreachable"}, 503)
 
 @app.route('/test-supabase')
 def test_supabase():
     try:
-        response = supabase.table("users").select("user_id").limit(1).execute()
-        return {"status": "success", "data": response.data}, 200
+        response = run_async(supabase.table("users").select("user_id").limit(1).execute())
+        return json_response({"status": "success", "data": response.data}, 200)
     except Exception as e:
-        logger.error(f"Supabase test failed: {str(e)}", exc_info=True)
-        return {"status": "error", "message": str(e)}, 500
+        logger.error("Supabase test failed: %s", e, exc_info=True)
+        return json_response({"status": "error", "message": str(e)}, 500)
 
 @app.route('/telegram', methods=['POST'])
 def telegram_webhook():
     try:
-        update_data = request.get_json()
+        raw_body = request.get_data()
+        update_data = orjson.loads(raw_body) if raw_body else None
         if not update_data:
             logger.warning("Received empty update from Telegram")
-            return {"status": "error", "message": "Empty update"}, 400
-        logger.info(f"Received Telegram update: {update_data}")
-        update = Update.de_json(update_data, application.bot)
-        if not update:
-            logger.warning("Failed to parse Telegram update")
-            return {"status": "error", "message": "Invalid update"}, 400
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+            return json_response({"status": "error", "message": "Empty update"}, 400)
+        logger.debug("Received Telegram update: %s", update_data)
         try:
-            loop.run_until_complete(application.process_update(update))
-        finally:
-            loop.close()
-        return {"status": "success"}, 200
+            processed = run_async(process_telegram_update(update_data))
+        except concurrent.futures.TimeoutError:
+            # Acknowledge anyway: a non-2xx makes Telegram redeliver, which could run /roll or /withdraw twice
+            logger.error("Timed out processing Telegram update %s", update_data.get('update_id'))
+            return json_response({"status": "error", "message": "Timed out"}, 200)
+        if not processed:
+            logger.warning("Failed to parse Telegram update")
+            return json_response({"status": "error", "message": "Invalid update"}, 400)
+        return json_response({"status": "success"}, 200)
     except Exception as e:
-        logger.error(f"Error in Telegram webhook: {str(e)}", exc_info=True)
-        return {"status": "error", "message": str(e)}, 500
+        logger.error("Error in Telegram webhook: %s", e, exc_info=True)
+        return json_response({"status": "error", "message": str(e)}, 500)
 
 @app.route('/tatum', methods=['POST'])
 def tatum_webhook():
     try:
         signature = request.headers.get('x-signature')
-        payload = request.get_json()
-        if not signature or not payload:
+        try:
+            raw_body = request.get_data(cache=False)
+        except RequestEntityTooLarge:
+            raw_body = None
+        if raw_body is None or len(raw_body) > MAX_TATUM_PAYLOAD:
+            logger.warning("Tatum webhook payload over %s bytes", MAX_TATUM_PAYLOAD)
+            return json_response({"status": "error", "message": "Payload too large"}, 413)
+        if not signature or not raw_body:
             logger.warning("Missing signature or payload in Tatum webhook")
-            return {"status": "error", "message": "Invalid request"}, 400
-        if not verify_tatum_signature(payload, signature):
+            return json_response({"status": "error", "message": "Invalid request"}, 400)
+        if not verify_tatum_signature(raw_body, signature):
             logger.warning("Invalid Tatum webhook signature")
-            return {"status": "error", "message": "Invalid signature"}, 403
+            return json_response({"status": "error", "message": "Invalid signature"}, 403)
+        payload = orjson.loads(raw_body)
         address = payload.get('address')
-        amount = float(payload.get('amount', 0))
-        currency = payload.get('currency', '').upper()
+        amount = str(payload.get('amount', 0))
+        currency = str(payload.get('currency', '')).upper()
         tx_id = payload.get('txId')
-        confirmations = int(payload.get('confirmations', 0))
-        currency_map = {
-            "SOLANA": "SOL",
-            "ETHEREUM": "ETH",
-            "LITECOIN": "LTC",
-            "BITCOIN": "BTC"
-        }
-        crypto = currency_map.get(currency)
+        if not isinstance(tx_id, str) or not tx_id:
+            # tx_id is the idempotency key; without one a redelivery would be credited again
+            logger.warning("Tatum webhook without a txId for address %s", address)
+            return json_response({"status": "error", "message": "Missing txId"}, 400)
+        if not isinstance(address, str) or not address:
+            logger.warning("Tatum webhook without an address (tx: %s)", tx_id)
+            return json_response({"status": "error", "message": "Missing address"}, 400)
+        crypto = CURRENCY_MAP.get(currency)
         if not crypto:
-            logger.warning(f"Unsupported currency: {currency}")
-            return {"status": "error", "message": "Unsupported currency"}, 400
-        confirmation_thresholds = {
-            "SOL": 1,
-            "ETH": 12,
-            "LTC": 6,
-            "BTC": 6
-        }
-        if confirmations < confirmation_thresholds.get(crypto, 1):
-            logger.info(f"Transaction {tx_id} for {crypto} has {confirmations} confirmations")
-            return {"status": "success", "message": "Waiting for confirmations"}, 200
-        response = supabase.table("transactions").select("id").eq("tx_id", tx_id).execute()
-        if response.data:
-            logger.info(f"Transaction {tx_id} already processed")
-            return {"status": "success", "message": "Transaction already processed"}, 200
-        response = supabase.table("users").select("user_id, balances").match({"deposit_addresses->>" + crypto: address}).execute()
-        user = response.data[0] if response.data else None
-        if not user:
-            logger.warning(f"No user found for address: {address}")
-            return {"status": "error", "message": "User not found"}, 404
-        new_balances = user['balances'].copy()
-        new_balances[crypto] = new_balances.get(crypto, 0.0) + amount
-        supabase.table("users").update({"balances": new_balances}).eq("user_id", user['user_id']).execute()
-        supabase.table("transactions").insert({
-            "user_id": user['user_id'],
-            "type": "deposit",
-            "crypto": crypto,
-            "amount": amount,
-            "address": address,
-            "tx_id": tx_id,
-            "confirmations": confirmations
-        }).execute()
-        logger.info(f"Deposited {amount} {crypto} for user {user['user_id']} (tx: {tx_id})")
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+            logger.warning("Unsupported currency: %s", currency)
+            return json_response({"status": "error", "message": "Unsupported currency"}, 400)
+        # Out-of-range values would fail inside batch_credit_deposits; reject them here instead
         try:
-            loop.run_until_complete(
-                application.bot.send_message(
-                    chat_id=user['user_id'],
-                    text=f"Deposit confirmed: {amount} {crypto} received!\nNew {crypto} balance: {new_balances[crypto]}"
-                )
-            )
-        finally:
-            loop.close()
-        return {"status": "success"}, 200
+            confirmations = int(payload.get('confirmations', 0))
+            units = to_units(crypto, amount)
+        except (TypeError, ValueError):
+            confirmations = units = None
+        if confirmations is None or not 0 <= confirmations <= MAX_CONFIRMATIONS or not 0 < units <= MAX_DEPOSIT_UNITS:
+            logger.warning("Invalid Tatum deposit (tx: %s): amount=%s confirmations=%s", tx_id, amount, payload.get('confirmations'))
+            return json_response({"status": "error", "message": "Invalid amount or confirmations"}, 400)
+        if confirmations < CONFIRMATION_THRESHOLDS.get(crypto, 1):
+            logger.info("Transaction %s for %s has %s confirmations", tx_id, crypto, confirmations)
+            return json_response({"status": "success", "message": "Waiting for confirmations"}, 200)
+        body, status = run_async(credit_deposit(address, crypto, amount, units, tx_id, confirmations))
+        return json_response(body, status)
     except Exception as e:
-        logger.error(f"Error in Tatum webhook: {str(e)}", exc_info=True)
-        return {"status": "error", "message": str(e)}, 500
+        logger.error("Error in Tatum webhook: %s", e, exc_info=True)
+        return json_response({"status": "error", "message": str(e)}, 500)
 
 @app.route('/setwebhook')
 def set_webhook():
@@ -532,18 +831,20 @@ def set_webhook():
         response = requests.get(f"https://api.telegram.org/bot{API_TOKEN}/setWebhook?url={webhook_url}")
         response.raise_for_status()
         logger.info("Webhook set successfully")
-        return {"status": "success", "message": "Webhook set"}, 200
+        return json_response({"status": "success", "message": "Webhook set"}, 200)
     except Exception as e:
-        logger.error(f"Failed to set webhook: {str(e)}", exc_info=True)
-        return {"status": "error", "message": str(e)}, 500
+        logger.error("Failed to set webhook: %s", e, exc_info=True)
+        return json_response({"status": "error", "message": str(e)}, 500)
 
 # Command handlers
-application.add_handler(CommandHandler('start', start))
-application.add_handler(CommandHandler('help', help_command))
-application.add_handler(CommandHandler('balance', balance))
-application.add_handler(CommandHandler('roll', roll))
-application.add_handler(CommandHandler('deposit', deposit))
-application.add_handler(CommandHandler('withdraw', withdraw))
+telegram_app.add_handler(CommandHandler('start', start))
+telegram_app.add_handler(CommandHandler('help', help_command))
+telegram_app.add_handler(CommandHandler('balance', balance))
+telegram_app.add_handler(CommandHandler('roll', roll))
+telegram_app.add_handler(CommandHandler('deposit', deposit))
+telegram_app.add_handler(CommandHandler('withdraw', withdraw))
+
+DEPOSIT_QUEUE = run_async(start_background_workers())
 
 # Export WSGI app
 application = app
\ No newline at end of file
@@ -1,10 +1,16 @@
+import asyncio
 import logging
 import os
 from dotenv import load_dotenv
-from telegram.ext import Application, CommandHandler
-from supabase import create_client, Client
-import random
-import requests
+from telegram.ext import AIORateLimiter, Application, CommandHandler
+from telegram.request import HTTPXRequest
+from supabase import create_client, Client, PostgrestAPIError
+from functools import lru_cache, partial
+from types import MappingProxyType
+from decimal import Decimal
+import httpx
+from cachetools import TTLCache
+from money import SCALE, to_units, format_units
 
 # Set up logging
 logging.basicConfig(
@@ -21,48 +27,125 @@ API_TOKEN = os.getenv("API_TOKEN")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 TATUM_API_KEY = os.getenv("TATUM_API_KEY")
+# HD wallet xpubs for ETH/LTC/BTC, generated offline by the operator who keeps the
+# mnemonic; never created here, since the keys of a runtime-created wallet are lost
+XPUBS = MappingProxyType({crypto: os.getenv(f"{crypto}_XPUB") for crypto in ("ETH", "LTC", "BTC")})
 
 # Validate environment variables
 if not all([API_TOKEN, SUPABASE_URL, SUPABASE_KEY, TATUM_API_KEY]):
     logger.error("Missing API_TOKEN, SUPABASE_URL, SUPABASE_KEY, or TATUM_API_KEY in .env file")
     raise ValueError("Missing required environment variables")
 
-# Connect to Supabase
+# Create the Supabase client (one client and connection pool per process).
+# No request is made here; the first query opens the connection.
+@lru_cache(maxsize=1)
+def get_supabase() -> Client:
+    return create_client(SUPABASE_URL, SUPABASE_KEY)
+
 try:
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-    response = supabase.table("users").select("user_id").limit(1).execute()
-    logger.info("Successfully connected to Supabase")
+    supabase = get_supabase()
 except Exception as e:
-    logger.error(f"Failed to connect to Supabase: {e}")
+    logger.error(f"Failed to create Supabase client: {e}")
     raise
 
+# Supported cryptocurrencies (tuple keeps messages ordered, frozenset for lookups)
+SUPPORTED_CRYPTOS = ("SOL", "LTC", "BTC", "ETH")
+VALID_CRYPTOS = frozenset(SUPPORTED_CRYPTOS)
+CHAIN_MAP = MappingProxyType({
+    "SOL": "solana",
+    "ETH": "ethereum",
+    "LTC": "litecoin",
+    "BTC": "bitcoin"
+})
+
+# user_id -> users row; updated in place after every write from this process
+USER_CACHE = TTLCache(maxsize=10_000, ttl=60)
+# The only columns any handler reads; the cached row serves all of them
+USER_COLUMNS = "user_id,balances,deposit_addresses"
+# user_id -> future for cache misses waiting on the next batched users query
+PENDING_USER_LOADS = {}
+# Strong references to fire-and-forget tasks so they aren't garbage collected mid-run
+BACKGROUND_TASKS = set()
+USER_LOAD_WINDOW = 0.005
+
+# New deposit addresses waiting to be written back; created on the bot's loop in post_init
+DEPOSIT_WRITE_QUEUE = None
+DEPOSIT_WRITE_WINDOW = 0.1
+DEPOSIT_WRITE_MAX_ATTEMPTS = 5
+DEPOSIT_WRITE_BACKOFF_FACTOR = 0.5
+
+# Pre-generated, not yet assigned deposit addresses live in the address_pool table
+# (migrations/015_address_pool.sql); kept well under the BIP44 gap limit of 20
+ADDRESS_POOL_SIZE = 8
+ADDRESS_POOL_REFILL_INTERVAL = 30
+
+# Static reply texts
+HELP_TEXT = (
+    "Available commands:\n"
+    "/start - Register or welcome back\n"
+    "/help - Show this message\n"
+    "/roll <crypto> <amount> - Roll dice with a bet (e.g., /roll SOL 1)\n"
+    "/deposit <crypto> - Get deposit address (e.g., /deposit SOL)\n"
+    "/withdraw <crypto> <amount> <address> - Withdraw funds (e.g., /withdraw SOL 0.1 <address>)\n"
+    "/balance - Check your balances"
+)
+USAGE_ROLL = "Usage: /roll <crypto> <amount>\nExample: /roll SOL 0.1"
+USAGE_DEPOSIT = "Usage: /deposit <crypto>\nExample: /deposit SOL"
+USAGE_WITHDRAW = "Usage: /withdraw <crypto> <amount> <address>\nExample: /withdraw SOL 0.1 <your-address>"
+
 # Tatum API base URL (testnet)
 TATUM_BASE_URL = "https://api.tatum.io/v3"
 
+# Shared async Tatum client: keep-alive pool, never blocks the event loop
+TATUM_CLIENT = httpx.AsyncClient(
+    headers={
+        "x-api-key": TATUM_API_KEY,
+        "Content-Type": "application/json"
+    },
+    timeout=httpx.Timeout(10.0, connect=3.0),
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        retries=3
+    )
+)
+
+# Helper function to reserve the next derivation index on a crypto's shared HD wallet
+async def reserve_address_index(crypto):
+    xpub = XPUBS.get(crypto)
+    if not xpub:
+        logger.error(f"{crypto}_XPUB is not configured; not deriving {crypto} addresses")
+        return None
+    reserve = supabase.rpc("next_address_index", {"p_crypto": crypto}).execute
+    response = await asyncio.to_thread(reserve)
+    if not response.data:
+        await asyncio.to_thread(
+            supabase.table("app_wallets").upsert(
+                {"crypto": crypto, "xpub": xpub},
+                on_conflict="crypto",
+                ignore_duplicates=True
+            ).execute
+        )
+        logger.info(f"Registered shared {crypto} wallet")
+        response = await asyncio.to_thread(reserve)
+    wallet = response.data[0] if response.data else None
+    if wallet and wallet['xpub'] != xpub:
+        logger.error(f"app_wallets holds a different {crypto} xpub than {crypto}_XPUB; not deriving addresses")
+        return None
+    return wallet
+
 # Helper function to generate a deposit address using Tatum
-def generate_deposit_address(crypto):
+async def generate_deposit_address(crypto):
     try:
-        chain_map = {
-            "SOL": "solana",
-            "ETH": "ethereum",
-            "LTC": "litecoin",
-            "BTC": "bitcoin"
-        }
-        chain = chain_map.get(crypto)
+        chain = CHAIN_MAP.get(crypto)
         if not chain:
             logger.error(f"Unsupported crypto: {crypto}")
             return None
 
-        # Generate a wallet
-        headers = {
-            "x-api-key": TATUM_API_KEY,
-            "Content-Type": "application/json"
-        }
-
         # For Solana, use the chain-specific endpoint
         if chain == "solana":
             url = f"{TATUM_BASE_URL}/{chain}/wallet"
-            response = requests.get(url, headers=headers)
+            response = await TATUM_CLIENT.get(url)
             response.raise_for_status()
             wallet_data = response.json()
             address = wallet_data.get("address")
@@ -71,18 +154,12 @@ def generate_deposit_address(crypto):
                 return None
             return address
 
-        # For Ethereum, Litecoin, and Bitcoin, derive an address from xpub
-        url = f"{TATUM_BASE_URL}/{chain}/wallet"
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        wallet_data = response.json()
-        xpub = wallet_data.get("xpub")
-        if not xpub:
-            logger.error(f"No xpub found in wallet response for {crypto}")
+        # For Ethereum, Litecoin, and Bitcoin, derive the next address from the shared xpub
+        wallet = await reserve_address_index(crypto)
+        if not wallet:
             return None
-
-        address_url = f"{TATUM_BASE_URL}/{chain}/address/{xpub}/0"
-        address_response = requests.get(address_url, headers=headers)
+        address_url = f"{TATUM_BASE_URL}/{chain}/address/{wallet['xpub']}/{wallet['address_index']}"
+        address_response = await TATUM_CLIENT.get(address_url)
         address_response.raise_for_status()
         address_data = address_response.json()
         return address_data["address"]
@@ -90,16 +167,118 @@ def generate_deposit_address(crypto):
         logger.error(f"Failed to generate deposit address for {crypto}: {e}")
         return None
 
+# Job that tops each crypto's address pool back up to ADDRESS_POOL_SIZE.
+# Addresses already pooled before a restart are counted, never regenerated.
+async def refill_address_pool(context):
+    for crypto in CHAIN_MAP:
+        try:
+            response = await asyncio.to_thread(
+                supabase.table("address_pool").select("address").eq("crypto", crypto).execute
+            )
+            rows = []
+            for _ in range(ADDRESS_POOL_SIZE - len(response.data)):
+                address = await generate_deposit_address(crypto)
+                if not address:
+                    break
+                rows.append({"address": address, "crypto": crypto})
+            if rows:
+                await asyncio.to_thread(supabase.table("address_pool").insert(rows).execute)
+        except Exception as e:
+            logger.error(f"Failed to refill {crypto} address pool: {e}")
+
+# Helper function to take a pooled address; None when the pool is empty or unreachable
+async def claim_pool_address(crypto):
+    try:
+        response = await asyncio.to_thread(supabase.rpc("claim_pool_address", {"p_crypto": crypto}).execute)
+        return response.data[0] if response.data else None
+    except Exception as e:
+        logger.error(f"Failed to claim a pooled {crypto} address: {e}")
+        return None
+
+# Raised by parse_cmd; the message is the reply to send back to the user
+class CommandArgsError(Exception):
+    pass
+
+# Helper function to validate "<crypto> [amount] [address]" command arguments in one pass;
+# the amount comes back in minor units
+def parse_cmd(args, argc, usage):
+    if len(args) != argc:
+        raise CommandArgsError(usage)
+    crypto = args[0].upper()
+    if crypto not in VALID_CRYPTOS:
+        raise CommandArgsError(f"Invalid cryptocurrency. Use one of: {', '.join(SUPPORTED_CRYPTOS)}")
+    units = None
+    if argc > 1:
+        try:
+            units = to_units(crypto, args[1])
+        except ValueError:
+            units = 0
+        if units <= 0:
+            raise CommandArgsError("Amount must be a positive number (e.g., 0.1)")
+    address = args[2] if argc > 2 else None
+    return crypto, units, address
+
+# Helper function to draw two fair dice from a single os.urandom call
+def two_d6():
+    while True:
+        b = os.urandom(2)
+        # The low 3 bits are uniform over 0..7; rejecting 6 and 7 leaves 0..5 uniform
+        a, c = b[0] & 7, b[1] & 7
+        if a < 6 and c < 6:
+            return a + 1, c + 1
+
+# Helper function to roll two dice; a total of 7 or more wins
+def resolve_roll(bet_units):
+    dice1, dice2 = two_d6()
+    total = dice1 + dice2
+    delta = bet_units if total >= 7 else -bet_units
+    return dice1, dice2, total, delta
+
+# Helper function to run a coroutine in the background, keeping a reference to it
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+# Helper function to read a user row, served from USER_CACHE when fresh.
+# Cache misses from concurrent handlers are coalesced into one .in_() query.
+async def get_user(user_id):
+    user = USER_CACHE.get(user_id)
+    if user is not None:
+        return user
+    future = PENDING_USER_LOADS.get(user_id)
+    if future is None:
+        if not PENDING_USER_LOADS:
+            spawn(flush_user_loads())
+        future = asyncio.get_running_loop().create_future()
+        PENDING_USER_LOADS[user_id] = future
+    return await asyncio.shield(future)
+
+async def flush_user_loads():
+    await asyncio.sleep(USER_LOAD_WINDOW)
+    pending = dict(PENDING_USER_LOADS)
+    PENDING_USER_LOADS.clear()
+    try:
+        response = await asyncio.to_thread(
+            supabase.table("users").select(USER_COLUMNS).in_("user_id", list(pending)).execute
+        )
+        rows = {row['user_id']: row for row in response.data}
+        for user_id, future in pending.items():
+            user = rows.get(user_id)
+            if user:
+                USER_CACHE[user_id] = user
+            future.set_result(user)
+    except Exception as e:
+        logger.error(f"Failed to load {len(pending)} users: {e}")
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(e)
+
 # Helper function to process a withdrawal (simulated for testnet)
 def process_withdrawal(crypto, amount, destination_address):
     try:
-        chain_map = {
-            "SOL": "solana",
-            "ETH": "ethereum",
-            "LTC": "litecoin",
-            "BTC": "bitcoin"
-        }
-        chain = chain_map.get(crypto)
+        chain = CHAIN_MAP.get(crypto)
         if not chain:
             return False, "Unsupported cryptocurrency"
 
@@ -111,292 +290,298 @@ def process_withdrawal(crypto, amount, destination_address):
         return False, str(e)
 
 async def start(update, context):
+    send = partial(context.bot.send_message, chat_id=update.effective_chat.id)
     try:
         user_id = update.effective_user.id
-        response = supabase.table("users").select("*").eq("user_id", user_id).execute()
-        user = response.data[0] if response.data else None
+        user = await get_user(user_id)
         if not user:
-            supabase.table("users").insert({
+            new_user = {
                 "user_id": user_id,
                 "balances": {
-                    "SOL": 10.0,
-                    "LTC": 10.0,
-                    "BTC": 0.001,  # Small initial balance for BTC (testnet)
-                    "ETH": 10.0
+                    "SOL": 10 * SCALE["SOL"],
+                    "LTC": 10 * SCALE["LTC"],
+                    "BTC": SCALE["BTC"] // 1000,  # Small initial balance for BTC (testnet)
+                    "ETH": 10 * SCALE["ETH"]
                 },
                 "deposit_addresses": {}
-            }).execute()
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="Welcome to the Casino Bot! You've been registered with 10 units of SOL, LTC, ETH, and 0.001 BTC. Use /help to see available commands."
-            )
+            }
+            await asyncio.to_thread(supabase.table("users").insert(new_user).execute)
+            USER_CACHE[user_id] = new_user
+            await send(text="Welcome to the Casino Bot! You've been registered with 10 units of SOL, LTC, ETH, and 0.001 BTC. Use /help to see available commands.")
             logger.info(f"Registered new user: {user_id}")
         else:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="Welcome back! Use /help to see available commands."
-            )
+            await send(text="Welcome back! Use /help to see available commands.")
             logger.info(f"User {user_id} returned")
     except Exception as e:
         logger.error(f"Database error in /start: {e}")
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Error accessing the database. Please try again later."
-        )
+        await send(text="Error accessing the database. Please try again later.")
 
 async def help_command(update, context):
-    await context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text="Available commands:\n/start - Register or welcome back\n/help - Show this message\n/roll <crypto> <amount> - Roll dice with a bet (e.g., /roll SOL 1)\n/deposit <crypto> - Get deposit address (e.g., /deposit SOL)\n/withdraw <crypto> <amount> <address> - Withdraw funds (e.g., /withdraw SOL 0.1 <address>)\n/balance - Check your balances"
-    )
+    send = partial(context.bot.send_message, chat_id=update.effective_chat.id)
+    await send(text=HELP_TEXT)
 
 async def balance(update, context):
+    send = partial(context.bot.send_message, chat_id=update.effective_chat.id)
     try:
         user_id = update.effective_user.id
-        response = supabase.table("users").select("balances").eq("user_id", user_id).execute()
-        user = response.data[0] if response.data else None
+        user = await get_user(user_id)
         if not user:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="You’re not registered. Use /start first."
-            )
+            await send(text="You’re not registered. Use /start first.")
             return
 
         balances = user['balances']
-        balance_text = "Your balances:\n" + "\n".join(f"{crypto}: {amount}" for crypto, amount in balances.items())
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=balance_text
-        )
+        lines = [f"{crypto}: {format_units(crypto, balances.get(crypto, 0))}" for crypto in SUPPORTED_CRYPTOS]
+        balance_text = "Your balances:\n" + "\n".join(lines)
+        await send(text=balance_text)
     except Exception as e:
         logger.error(f"Database error in /balance: {e}")
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Error accessing the database. Please try again later."
-        )
+        await send(text="Error accessing the database. Please try again later.")
 
 async def roll(update, context):
+    send = partial(context.bot.send_message, chat_id=update.effective_chat.id)
     try:
         user_id = update.effective_user.id
-        args = context.args
-
-        if len(args) != 2:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="Usage: /roll <crypto> <amount>\nExample: /roll SOL 0.1"
-            )
-            return
-
-        crypto, amount_str = args[0].upper(), args[1]
-        valid_cryptos = ['SOL', 'LTC', 'BTC', 'ETH']
-
-        if crypto not in valid_cryptos:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"Invalid cryptocurrency. Use one of: {', '.join(valid_cryptos)}"
-            )
-            return
-
         try:
-            bet_amount = float(amount_str)
-            if bet_amount <= 0:
-                raise ValueError
-        except ValueError:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="Amount must be a positive number (e.g., 0.1)"
-            )
+            crypto, bet_units, _ = parse_cmd(context.args, 2, USAGE_ROLL)
+        except CommandArgsError as e:
+            await send(text=str(e))
             return
 
-        response = supabase.table("users").select("balances").eq("user_id", user_id).execute()
-        user = response.data[0] if response.data else None
+        user = await get_user(user_id)
         if not user:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="You’re not registered. Use /start first."
-            )
-            return
-
-        current_balance = user['balances'].get(crypto, 0.0)
-        if current_balance < bet_amount:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"Insufficient {crypto} balance. Your balance: {current_balance}"
-            )
+            await send(text="You’re not registered. Use /start first.")
             return
 
-        dice1 = random.randint(1, 6)
-        dice2 = random.randint(1, 6)
-        total = dice1 + dice2
-
-        if total >= 7:
-            winnings = bet_amount * 2
-            new_balance = current_balance + bet_amount
+        dice1, dice2, total, delta = resolve_roll(bet_units)
+        if delta > 0:
+            winnings = format_units(crypto, bet_units * 2)
             result = f"🎲 You rolled {dice1} + {dice2} = {total}\nYou won! +{winnings} {crypto}"
         else:
-            new_balance = current_balance - bet_amount
-            result = f"🎲 You rolled {dice1} + {dice2} = {total}\nYou lost! -{bet_amount} {crypto}"
-
-        updated_balances = user['balances'].copy()
-        updated_balances[crypto] = new_balance
-        supabase.table("users").update({"balances": updated_balances}).eq("user_id", user_id).execute()
+            result = f"🎲 You rolled {dice1} + {dice2} = {total}\nYou lost! -{format_units(crypto, bet_units)} {crypto}"
+
+        # Balance check and update happen atomically in Postgres; the cached balance may be
+        # missing deposits credited by another process, so it is never checked here
+        response = await asyncio.to_thread(supabase.rpc("roll_dice", {
+            "p_user_id": user_id,
+            "p_crypto": crypto,
+            "p_bet": bet_units,
+            "p_delta": delta
+        }).execute)
+        if not response.data:
+            # Re-read so the reply shows the real balance
+            USER_CACHE.pop(user_id, None)
+            user = await get_user(user_id)
+            current_balance = user['balances'].get(crypto, 0) if user else 0
+            await send(text=f"Insufficient {crypto} balance. Your balance: {format_units(crypto, current_balance)}")
+            return
+        user['balances'] = response.data[0]['new_balances']
+        new_balance = format_units(crypto, user['balances'][crypto])
         logger.info(f"User {user_id} rolled dice, new {crypto} balance: {new_balance}")
 
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=f"{result}\nNew {crypto} balance: {new_balance}"
-        )
+        await send(text=f"{result}\nNew {crypto} balance: {new_balance}")
     except Exception as e:
         logger.error(f"Database error in /roll: {e}")
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Error accessing the database. Please try again later."
-        )
+        await send(text="Error accessing the database. Please try again later.")
 
 async def deposit(update, context):
+    send = partial(context.bot.send_message, chat_id=update.effective_chat.id)
     try:
         user_id = update.effective_user.id
-        args = context.args
-
-        if len(args) != 1:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="Usage: /deposit <crypto>\nExample: /deposit SOL"
-            )
-            return
-
-        crypto = args[0].upper()
-        valid_cryptos = ['SOL', 'LTC', 'BTC', 'ETH']
-
-        if crypto not in valid_cryptos:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"Invalid cryptocurrency. Use one of: {', '.join(valid_cryptos)}"
-            )
+        try:
+            crypto, _, _ = parse_cmd(context.args, 1, USAGE_DEPOSIT)
+        except CommandArgsError as e:
+            await send(text=str(e))
             return
 
-        response = supabase.table("users").select("deposit_addresses").eq("user_id", user_id).execute()
-        user = response.data[0] if response.data else None
+        user = await get_user(user_id)
         if not user:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="You’re not registered. Use /start first."
-            )
+            await send(text="You’re not registered. Use /start first.")
             return
 
-        deposit_addresses = user['deposit_addresses'] or {}
+        deposit_addresses = dict(user['deposit_addresses'] or {})
         if crypto in deposit_addresses:
             address = deposit_addresses[crypto]
         else:
-            address = generate_deposit_address(crypto)
+            address = await claim_pool_address(crypto) or await generate_deposit_address(crypto)
             if not address:
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=f"Failed to generate a deposit address for {crypto}. Please try again later."
-                )
+                await send(text=f"Failed to generate a deposit address for {crypto}. Please try again later.")
                 return
 
             deposit_addresses[crypto] = address
-            supabase.table("users").update({"deposit_addresses": deposit_addresses}).eq("user_id", user_id).execute()
+            user['deposit_addresses'] = deposit_addresses
+            # Persisted in the background; the cached row already has the address
+            DEPOSIT_WRITE_QUEUE.put_nowait({"user_id": user_id, "crypto": crypto, "address": address})
             logger.info(f"Generated deposit address for user {user_id}: {crypto} - {address}")
 
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=f"Your {crypto} deposit address (testnet):\n{address}\nSend {crypto} to this address to deposit funds."
-        )
+        await send(text=f"Your {crypto} deposit address (testnet):\n{address}\nSend {crypto} to this address to deposit funds.")
     except Exception as e:
         logger.error(f"Error in /deposit: {e}")
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="An error occurred while generating the deposit address. Please try again later."
-        )
+        await send(text="An error occurred while generating the deposit address. Please try again later.")
 
 async def withdraw(update, context):
+    send = partial(context.bot.send_message, chat_id=update.effective_chat.id)
     try:
         user_id = update.effective_user.id
-        args = context.args
-
-        if len(args) != 3:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="Usage: /withdraw <crypto> <amount> <address>\nExample: /withdraw SOL 0.1 <your-address>"
-            )
-            return
-
-        crypto, amount_str, destination_address = args[0].upper(), args[1], args[2]
-        valid_cryptos = ['SOL', 'LTC', 'BTC', 'ETH']
-
-        if crypto not in valid_cryptos:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"Invalid cryptocurrency. Use one of: {', '.join(valid_cryptos)}"
-            )
-            return
-
         try:
-            amount = float(amount_str)
-            if amount <= 0:
-                raise ValueError
-        except ValueError:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="Amount must be a positive number (e.g., 0.1)"
-            )
+            crypto, units, destination_address = parse_cmd(context.args, 3, USAGE_WITHDRAW)
+        except CommandArgsError as e:
+            await send(text=str(e))
             return
 
-        response = supabase.table("users").select("balances").eq("user_id", user_id).execute()
-        user = response.data[0] if response.data else None
+        user = await get_user(user_id)
         if not user:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="You’re not registered. Use /start first."
-            )
+            await send(text="You’re not registered. Use /start first.")
             return
 
-        current_balance = user['balances'].get(crypto, 0.0)
-        if current_balance < amount:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"Insufficient {crypto} balance. Your balance: {current_balance}"
-            )
+        # Debit first: the RPC checks the live balance (the cached one may miss deposits
+        # credited elsewhere), and two concurrent withdrawals can't both pass it
+        try:
+            response = await asyncio.to_thread(supabase.rpc("apply_balance_delta", {
+                "p_user_id": user_id,
+                "p_crypto": crypto,
+                "p_delta": -units
+            }).execute)
+        except PostgrestAPIError as e:
+            if e.message != "insufficient_funds":
+                raise
+            USER_CACHE.pop(user_id, None)
+            await send(text=f"Insufficient {crypto} balance. Your balance: {format_units(crypto, Decimal(e.details))}")
+            return
+        if not response.data:
+            USER_CACHE.pop(user_id, None)
+            await send(text="You’re not registered. Use /start first.")
             return
+        user['balances'] = response.data[0]['new_balances']
+        new_balance = format_units(crypto, user['balances'][crypto])
 
+        amount = format_units(crypto, units)
         success, message = process_withdrawal(crypto, amount, destination_address)
         if not success:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"Withdrawal failed: {message}"
-            )
+            # Refund the debited amount
+            try:
+                response = await asyncio.to_thread(supabase.rpc("apply_balance_delta", {
+                    "p_user_id": user_id,
+                    "p_crypto": crypto,
+                    "p_delta": units
+                }).execute)
+            except Exception as e:
+                response = None
+                logger.error(f"Refund failed: {e}")
+            if not response or not response.data:
+                # The debit stands; everything needed to refund by hand is in this line
+                USER_CACHE.pop(user_id, None)
+                logger.error(f"REFUND NEEDED: user {user_id} was debited {units} {crypto} units ({amount} {crypto}) for a failed withdrawal")
+            else:
+                user['balances'] = response.data[0]['new_balances']
+            await send(text=f"Withdrawal failed: {message}")
             return
 
-        new_balance = current_balance - amount
-        updated_balances = user['balances'].copy()
-        updated_balances[crypto] = new_balance
-        supabase.table("users").update({"balances": updated_balances}).eq("user_id", user_id).execute()
         logger.info(f"User {user_id} withdrew {amount} {crypto}, new balance: {new_balance}")
 
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=f"Successfully withdrew {amount} {crypto} to {destination_address}\nNew {crypto} balance: {new_balance}"
-        )
+        await send(text=f"Successfully withdrew {amount} {crypto} to {destination_address}\nNew {crypto} balance: {new_balance}")
     except Exception as e:
         logger.error(f"Error in /withdraw: {e}")
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="An error occurred while processing the withdrawal. Please try again later."
-        )
+        await send(text="An error occurred while processing the withdrawal. Please try again later.")
+
+# Liveness check run in the background once polling starts, so it never delays startup
+async def probe_supabase():
+    try:
+        await asyncio.to_thread(supabase.table("users").select("user_id").limit(1).execute)
+        logger.info("Successfully connected to Supabase")
+    except Exception as e:
+        logger.error(f"Failed to connect to Supabase: {e}")
+
+# Retries with backoff; deposits to an address that never reaches deposit_addresses can't be credited
+async def save_deposit_addresses(batch):
+    for attempt in range(1, DEPOSIT_WRITE_MAX_ATTEMPTS + 1):
+        try:
+            await asyncio.to_thread(supabase.rpc("save_deposit_addresses", {"p_rows": batch}).execute)
+            return
+        except Exception as e:
+            logger.warning(f"Failed to save {len(batch)} deposit addresses: {e} (attempt {attempt})")
+        if attempt < DEPOSIT_WRITE_MAX_ATTEMPTS:
+            await asyncio.sleep(DEPOSIT_WRITE_BACKOFF_FACTOR * 2 ** (attempt - 1))
+    # The cached rows claim these addresses are saved; drop them so the next command re-reads the DB
+    for row in batch:
+        USER_CACHE.pop(row["user_id"], None)
+    logger.error(f"Giving up on saving deposit addresses after {DEPOSIT_WRITE_MAX_ATTEMPTS} attempts, reconcile manually: {batch}")
+
+def drain_queue(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+# Background writer that flushes queued deposit addresses in one RPC per window
+async def deposit_address_writer(queue):
+    while True:
+        batch = [await queue.get()]
+        try:
+            await asyncio.sleep(DEPOSIT_WRITE_WINDOW)
+        finally:
+            # Also runs when cancelled at shutdown, so a picked-up batch is never dropped
+            batch.extend(drain_queue(queue))
+            save = asyncio.ensure_future(save_deposit_addresses(batch))
+            try:
+                await asyncio.shield(save)
+            except asyncio.CancelledError:
+                # Cancelled mid-write: finish the write, then let the cancellation through
+                await save
+                raise
+
+async def start_background_tasks(application):
+    global DEPOSIT_WRITE_QUEUE
+    DEPOSIT_WRITE_QUEUE = asyncio.Queue()
+    spawn(deposit_address_writer(DEPOSIT_WRITE_QUEUE))
+    spawn(probe_supabase())
+
+async def shutdown(application):
+    tasks = list(BACKGROUND_TASKS)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # Anything the writer hadn't picked up yet is saved before exit
+    # (the queue is still None if post_init never ran)
+    remaining = drain_queue(DEPOSIT_WRITE_QUEUE) if DEPOSIT_WRITE_QUEUE is not None else []
+    if remaining:
+        await save_deposit_addresses(remaining)
+    await TATUM_CLIENT.aclose()
 
 async def error_handler(update, context):
     logger.error(f"Update {update} caused error: {context.error}")
     if update:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="An error occurred. Please try again later."
-        )
+        send = partial(context.bot.send_message, chat_id=update.effective_chat.id)
+        await send(text="An error occurred. Please try again later.")
 
 def main():
     try:
-        application = Application.builder().token(API_TOKEN).build()
+        application = (
+            Application.builder()
+            .token(API_TOKEN)
+            # Enough pooled connections that concurrent handlers don't queue on replies
+            .request(HTTPXRequest(
+                connection_pool_size=64,
+                connect_timeout=5,
+                read_timeout=20,
+                write_timeout=20,
+                pool_timeout=30,
+                http_version="2"
+            ))
+            .get_updates_request(HTTPXRequest(connection_pool_size=8))
+            .post_init(start_background_tasks)
+            .post_shutdown(shutdown)
+            # Pace outbound calls under Telegram's global and per-group limits
+            .rate_limiter(AIORateLimiter(
+                overall_max_rate=29,
+                overall_time_period=1,
+                group_max_rate=20,
+                group_time_period=60,
+                max_retries=3
+            ))
+            # Lets get_user coalesce lookups from updates handled at the same time
+            .concurrent_updates(True)
+            .build()
+        )
         application.add_handler(CommandHandler('start', start))
         application.add_handler(CommandHandler('help', help_command))
         application.add_handler(CommandHandler('balance', balance))
@@ -404,6 +589,7 @@ def main():
         application.add_handler(CommandHandler('deposit', deposit))
         application.add_handler(CommandHandler('withdraw', withdraw))
         application.add_error_handler(error_handler)
+        application.job_queue.run_repeating(refill_address_pool, interval=ADDRESS_POOL_REFILL_INTERVAL, first=0)
         logger.info("Starting Telegram bot...")
         application.run_polling(allowed_updates=["message", "callback_query"])
     except Exception as e:
@@ -0,0 +1,17 @@
+# Self-hosted entrypoint: gunicorn -c gunicorn.conf.py app:app
+# Vercel serves app.py as a serverless function and does not read this file.
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8080")
+# Both classes keep ~100 requests in flight per process; the actual I/O is
+# multiplexed on app.py's background event loop either way.
+worker_class = os.getenv("WORKER_CLASS", "gevent")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+if worker_class == "gthread":
+    threads = int(os.getenv("THREADS", "50"))
+elif worker_class == "gevent":
+    worker_connections = 1000
+    # Tell app.py to monkey-patch before anything else is imported
+    raw_env = ["USE_GEVENT=1"]
+# Any other class (e.g. sync) is passed through to gunicorn unchanged, without gevent
+timeout = 30
@@ -0,0 +1,24 @@
+-- Atomically apply a balance delta for one crypto in a single round-trip.
+-- The row is only updated when the current balance covers p_bet, so the
+-- read-modify-write happens inside Postgres instead of across two requests.
+-- Returns the updated balances, or no rows when the user is missing or the
+-- balance is too low.
+create or replace function roll_dice(
+    p_user_id bigint,
+    p_crypto text,
+    p_bet numeric,
+    p_delta numeric
+)
+returns table (new_balances jsonb)
+language sql
+as $$
+    update users
+    set balances = jsonb_set(
+        balances,
+        array[p_crypto],
+        to_jsonb(coalesce((balances->>p_crypto)::numeric, 0) + p_delta)
+    )
+    where user_id = p_user_id
+      and coalesce((balances->>p_crypto)::numeric, 0) >= p_bet
+    returning balances;
+$$;
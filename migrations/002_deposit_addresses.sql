@@ -0,0 +1,14 @@
+-- Address -> user lookup table for incoming Tatum webhooks.
+-- Matching on users.deposit_addresses->>crypto scans and decodes every row's
+-- JSONB; the primary key on address turns that into a btree lookup.
+create table if not exists deposit_addresses (
+    address text primary key,
+    user_id bigint not null,
+    crypto text not null
+);
+
+-- Backfill addresses handed out before this table existed
+insert into deposit_addresses (address, user_id, crypto)
+select a.value, u.user_id, a.key
+from users u, jsonb_each_text(coalesce(u.deposit_addresses, '{}'::jsonb)) a
+on conflict (address) do nothing;
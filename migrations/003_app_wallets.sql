@@ -0,0 +1,19 @@
+-- One HD wallet (xpub) per crypto, shared by all users. Each /deposit
+-- reserves the next derivation index instead of creating a new wallet.
+create table if not exists app_wallets (
+    crypto text primary key,
+    xpub text not null,
+    next_index integer not null default 0
+);
+
+-- Atomically reserve the next derivation index for a crypto's wallet.
+-- Returns no rows when the wallet has not been created yet.
+create or replace function next_address_index(p_crypto text)
+returns table (xpub text, address_index integer)
+language sql
+as $$
+    update app_wallets
+    set next_index = next_index + 1
+    where crypto = p_crypto
+    returning app_wallets.xpub, app_wallets.next_index - 1;
+$$;
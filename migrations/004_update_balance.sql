@@ -0,0 +1,20 @@
+-- Unconditionally add delta to one crypto's balance and return the result.
+-- Used for credits (deposits, refunds) where no minimum balance applies;
+-- only the changed key is sent over the wire, not the whole balances blob.
+create or replace function update_balance(
+    p_user_id bigint,
+    p_crypto text,
+    p_delta numeric
+)
+returns table (new_balances jsonb)
+language sql
+as $$
+    update users
+    set balances = jsonb_set(
+        balances,
+        array[p_crypto],
+        to_jsonb(coalesce((balances->>p_crypto)::numeric, 0) + p_delta)
+    )
+    where user_id = p_user_id
+    returning balances;
+$$;
@@ -0,0 +1,3 @@
+-- Make tx_id the idempotency key for Tatum webhooks so a duplicate delivery
+-- can be detected by the insert itself (ON CONFLICT DO NOTHING).
+create unique index if not exists transactions_tx_id_uidx on transactions (tx_id);
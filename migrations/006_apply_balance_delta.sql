@@ -0,0 +1,37 @@
+-- Atomically apply a signed delta to one crypto's balance and return the
+-- updated balances. Debits that would take the balance below zero raise
+-- 'insufficient_funds' with the current balance in the error detail, so the
+-- caller can report it without a second query. Returns no rows when the user
+-- does not exist.
+create or replace function apply_balance_delta(
+    p_user_id bigint,
+    p_crypto text,
+    p_delta numeric
+)
+returns table (new_balances jsonb)
+language plpgsql
+as $$
+declare
+    v_current numeric;
+begin
+    select coalesce((u.balances->>p_crypto)::numeric, 0)
+    into v_current
+    from users u
+    where u.user_id = p_user_id
+    for update;
+    if not found then
+        return;
+    end if;
+    if v_current + p_delta < 0 then
+        raise exception 'insufficient_funds' using detail = v_current::text;
+    end if;
+    return query
+    update users u
+    set balances = jsonb_set(u.balances, array[p_crypto], to_jsonb(v_current + p_delta))
+    where u.user_id = p_user_id
+    returning u.balances;
+end;
+$$;
+
+-- Superseded by apply_balance_delta
+drop function if exists update_balance(bigint, text, numeric);
@@ -0,0 +1,43 @@
+-- Record a Tatum deposit and credit it in one transaction. The insert into
+-- transactions is the idempotency check (unique tx_id, ON CONFLICT DO
+-- NOTHING): only the first delivery of a tx_id credits the balance.
+-- Returns no rows when the address is unknown; credited is false (and
+-- new_balances null) for a duplicate delivery.
+create or replace function credit_deposit(
+    p_address text,
+    p_crypto text,
+    p_amount numeric,
+    p_tx_id text,
+    p_confirmations integer
+)
+returns table (user_id bigint, credited boolean, new_balances jsonb)
+language plpgsql
+as $$
+declare
+    v_user_id bigint;
+    v_balances jsonb;
+begin
+    select d.user_id into v_user_id
+    from deposit_addresses d
+    where d.address = p_address;
+    if not found then
+        return;
+    end if;
+    insert into transactions (user_id, type, crypto, amount, address, tx_id, confirmations)
+    values (v_user_id, 'deposit', p_crypto, p_amount, p_address, p_tx_id, p_confirmations)
+    on conflict (tx_id) do nothing;
+    if not found then
+        return query select v_user_id, false, null::jsonb;
+        return;
+    end if;
+    update users u
+    set balances = jsonb_set(
+        u.balances,
+        array[p_crypto],
+        to_jsonb(coalesce((u.balances->>p_crypto)::numeric, 0) + p_amount)
+    )
+    where u.user_id = v_user_id
+    returning u.balances into v_balances;
+    return query select v_user_id, true, v_balances;
+end;
+$$;
@@ -0,0 +1,26 @@
+-- Credit a batch of Tatum deposits in one round-trip. p_events is a JSON
+-- array of {address, crypto, amount, tx_id, confirmations}; each event goes
+-- through credit_deposit in array order, so duplicates within a batch are
+-- caught by the same tx_id check. idx is the event's 1-based position;
+-- events for unknown addresses produce no row.
+create or replace function batch_credit_deposits(p_events jsonb)
+returns table (idx bigint, user_id bigint, credited boolean, new_balances jsonb)
+language plpgsql
+as $$
+declare
+    e record;
+begin
+    for e in
+        select r.idx, r.address, r.crypto, r.amount, r.tx_id, r.confirmations
+        from rows from (
+            jsonb_to_recordset(p_events)
+                as (address text, crypto text, amount numeric, tx_id text, confirmations integer)
+        ) with ordinality as r(address, crypto, amount, tx_id, confirmations, idx)
+        order by r.idx
+    loop
+        return query
+        select e.idx, c.user_id, c.credited, c.new_balances
+        from credit_deposit(e.address, e.crypto, e.amount, e.tx_id, e.confirmations) c;
+    end loop;
+end;
+$$;
@@ -0,0 +1,81 @@
+-- Store balances as integer minor units: lamports (SOL, 1e9), litoshis (LTC,
+-- 1e8), satoshis (BTC, 1e8) and gwei (ETH, 1e9). ETH uses gwei rather than
+-- wei so every balance stays within a 64-bit integer. Run exactly once:
+-- unlike the other migrations this one is not idempotent.
+update users u
+set balances = (
+    select coalesce(
+        jsonb_object_agg(b.key, coalesce(round(b.value::numeric * s.scale), b.value::numeric)),
+        '{}'::jsonb
+    )
+    from jsonb_each_text(coalesce(u.balances, '{}'::jsonb)) b
+    left join (values ('SOL', 1e9), ('LTC', 1e8), ('BTC', 1e8), ('ETH', 1e9)) s(crypto, scale)
+        on s.crypto = b.key
+);
+
+-- The transactions row keeps Tatum's decimal amount; p_units is the same
+-- amount in minor units and is what gets added to the balance.
+drop function if exists batch_credit_deposits(jsonb);
+drop function if exists credit_deposit(text, text, numeric, text, integer);
+
+create or replace function credit_deposit(
+    p_address text,
+    p_crypto text,
+    p_amount numeric,
+    p_units numeric,
+    p_tx_id text,
+    p_confirmations integer
+)
+returns table (user_id bigint, credited boolean, new_balances jsonb)
+language plpgsql
+as $$
+declare
+    v_user_id bigint;
+    v_balances jsonb;
+begin
+    select d.user_id into v_user_id
+    from deposit_addresses d
+    where d.address = p_address;
+    if not found then
+        return;
+    end if;
+    insert into transactions (user_id, type, crypto, amount, address, tx_id, confirmations)
+    values (v_user_id, 'deposit', p_crypto, p_amount, p_address, p_tx_id, p_confirmations)
+    on conflict (tx_id) do nothing;
+    if not found then
+        return query select v_user_id, false, null::jsonb;
+        return;
+    end if;
+    update users u
+    set balances = jsonb_set(
+        u.balances,
+        array[p_crypto],
+        to_jsonb(coalesce((u.balances->>p_crypto)::numeric, 0) + p_units)
+    )
+    where u.user_id = v_user_id
+    returning u.balances into v_balances;
+    return query select v_user_id, true, v_balances;
+end;
+$$;
+
+create or replace function batch_credit_deposits(p_events jsonb)
+returns table (idx bigint, user_id bigint, credited boolean, new_balances jsonb)
+language plpgsql
+as $$
+declare
+    e record;
+begin
+    for e in
+        select r.idx, r.address, r.crypto, r.amount, r.units, r.tx_id, r.confirmations
+        from rows from (
+            jsonb_to_recordset(p_events)
+                as (address text, crypto text, amount numeric, units numeric, tx_id text, confirmations integer)
+        ) with ordinality as r(address, crypto, amount, units, tx_id, confirmations, idx)
+        order by r.idx
+    loop
+        return query
+        select e.idx, c.user_id, c.credited, c.new_balances
+        from credit_deposit(e.address, e.crypto, e.amount, e.units, e.tx_id, e.confirmations) c;
+    end loop;
+end;
+$$;
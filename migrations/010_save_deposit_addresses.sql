@@ -0,0 +1,24 @@
+-- Persist a batch of newly assigned deposit addresses in one round-trip.
+-- p_rows is a JSON array of {user_id, crypto, address}. Addresses are merged
+-- into users.deposit_addresses (so concurrent writers never overwrite each
+-- other's keys) and recorded in deposit_addresses for the Tatum webhook.
+-- Returns the addresses that were newly recorded.
+create or replace function save_deposit_addresses(p_rows jsonb)
+returns setof text
+language sql
+as $$
+    update users u
+    set deposit_addresses = coalesce(u.deposit_addresses, '{}'::jsonb) || r.addresses
+    from (
+        select x.user_id, jsonb_object_agg(x.crypto, x.address) as addresses
+        from jsonb_to_recordset(p_rows) as x(user_id bigint, crypto text, address text)
+        group by x.user_id
+    ) r
+    where u.user_id = r.user_id;
+
+    insert into deposit_addresses (address, user_id, crypto)
+    select x.address, x.user_id, x.crypto
+    from jsonb_to_recordset(p_rows) as x(user_id bigint, crypto text, address text)
+    on conflict (address) do nothing
+    returning address;
+$$;
@@ -0,0 +1,9 @@
+-- Unique indexes treat NULLs as distinct, so a deposit with no tx_id slipped
+-- past ON CONFLICT (tx_id) and was credited again on every redelivery.
+-- Rows recorded that way get a placeholder id; afterwards inserting a NULL
+-- tx_id fails instead of crediting.
+update transactions
+set tx_id = 'missing-' || gen_random_uuid()
+where tx_id is null;
+
+alter table transactions alter column tx_id set not null;
@@ -0,0 +1,47 @@
+-- Isolate failures inside a deposit batch. Each event is credited in its own
+-- subtransaction: an event that raises (bad value, constraint violation) is
+-- rolled back alone and reported through error, instead of aborting the
+-- whole batch and every co-batched webhook with it. Event fields are read
+-- as text and cast inside that subtransaction, so a value that doesn't fit
+-- its column fails only its own event too.
+drop function if exists batch_credit_deposits(jsonb);
+
+create or replace function batch_credit_deposits(p_events jsonb)
+returns table (idx bigint, user_id bigint, credited boolean, new_balances jsonb, error text)
+language plpgsql
+as $$
+declare
+    e record;
+    v_found boolean;
+begin
+    for e in
+        select r.idx, r.address, r.crypto, r.amount, r.units, r.tx_id, r.confirmations
+        from rows from (
+            jsonb_to_recordset(p_events)
+                as (address text, crypto text, amount text, units text, tx_id text, confirmations text)
+        ) with ordinality as r(address, crypto, amount, units, tx_id, confirmations, idx)
+        order by r.idx
+    loop
+        user_id := null;
+        credited := null;
+        new_balances := null;
+        error := null;
+        v_found := false;
+        begin
+            select c.user_id, c.credited, c.new_balances
+            into user_id, credited, new_balances
+            from credit_deposit(
+                e.address, e.crypto, e.amount::numeric, e.units::numeric, e.tx_id, e.confirmations::integer
+            ) c;
+            v_found := found;
+        exception when others then
+            error := sqlerrm;
+        end;
+        -- Unknown addresses still produce no row
+        if v_found or error is not null then
+            idx := e.idx;
+            return next;
+        end if;
+    end loop;
+end;
+$$;
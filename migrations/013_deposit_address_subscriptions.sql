@@ -0,0 +1,12 @@
+-- Track the Tatum subscription of each deposit address in the database, so a
+-- failed subscription is retried by any live app.py instance instead of
+-- living in one process's memory. Addresses that already exist went through
+-- the old subscribe-on-creation path and are assumed subscribed; new rows
+-- start unsubscribed.
+alter table deposit_addresses
+    add column if not exists subscribed boolean not null default true,
+    add column if not exists subscribe_attempts integer not null default 0;
+alter table deposit_addresses alter column subscribed set default false;
+
+create index if not exists deposit_addresses_unsubscribed_idx
+    on deposit_addresses (address) where not subscribed;
@@ -0,0 +1,8 @@
+-- Every app_wallets row so far was created at runtime from Tatum's /wallet
+-- response with the mnemonic discarded, so nobody holds its keys. Drop them:
+-- the xpubs now come from ETH_XPUB / LTC_XPUB / BTC_XPUB (generated offline)
+-- and are registered with next_index 0 on the first address request.
+-- Funds already sent to addresses derived from the dropped wallets can't be
+-- recovered by this change; those addresses stay in deposit_addresses so
+-- deposits to them are still credited.
+delete from app_wallets;
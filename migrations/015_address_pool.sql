@@ -0,0 +1,27 @@
+-- Pre-generated, not yet assigned deposit addresses. Kept in the database
+-- rather than process memory so a restart reuses them instead of reserving
+-- fresh HD indexes (and leaving a run of unused ones past the BIP44 gap
+-- limit of 20).
+create table if not exists address_pool (
+    address text primary key,
+    crypto text not null,
+    created_at timestamptz not null default now()
+);
+create index if not exists address_pool_crypto_idx on address_pool (crypto, created_at);
+
+-- Atomically take the oldest pooled address for a crypto; no rows when empty.
+create or replace function claim_pool_address(p_crypto text)
+returns setof text
+language sql
+as $$
+    delete from address_pool
+    where address = (
+        select address
+        from address_pool
+        where crypto = p_crypto
+        order by created_at
+        limit 1
+        for update skip locked
+    )
+    returning address;
+$$;
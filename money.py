@@ -0,0 +1,32 @@
+# Balance scaling shared by app.py and bot.py; both write the same users.balances,
+# so there must be exactly one copy of these.
+from types import MappingProxyType
+from decimal import Decimal, ROUND_DOWN
+
+# Balances are integer minor units: lamports, litoshis, satoshis and gwei.
+# ETH uses gwei rather than wei so balances stay in a 64-bit integer range; any
+# sub-gwei dust of a deposit is dropped from the balance, while the transactions
+# row keeps Tatum's full decimal amount.
+DECIMALS = MappingProxyType({
+    "SOL": 9,
+    "LTC": 8,
+    "BTC": 8,
+    "ETH": 9
+})
+SCALE = MappingProxyType({crypto: 10 ** places for crypto, places in DECIMALS.items()})
+
+# Helper function to convert a decimal amount to integer minor units, truncating sub-unit dust
+def to_units(crypto, amount):
+    try:
+        return int((Decimal(str(amount)) * SCALE[crypto]).to_integral_value(rounding=ROUND_DOWN))
+    except ArithmeticError:
+        raise ValueError(f"Invalid {crypto} amount: {amount}")
+
+# Helper function to render integer minor units as a decimal amount
+def format_units(crypto, units):
+    units = int(units)
+    # divmod floors negatives, so split the sign off first
+    sign = "-" if units < 0 else ""
+    whole, frac = divmod(abs(units), SCALE[crypto])
+    frac = f"{frac:0{DECIMALS[crypto]}d}".rstrip("0")
+    return f"{sign}{whole}.{frac}" if frac else f"{sign}{whole}"
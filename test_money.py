@@ -0,0 +1,42 @@
+import pytest
+
+from money import SCALE, to_units, format_units
+
+def test_scale_per_crypto():
+    assert SCALE == {"SOL": 10 ** 9, "LTC": 10 ** 8, "BTC": 10 ** 8, "ETH": 10 ** 9}
+
+def test_to_units_rounds_down_sub_unit_dust():
+    assert to_units("BTC", "0.123456789") == 12_345_678
+    assert to_units("SOL", "0.0000000019") == 1
+
+def test_to_units_eth_is_gwei():
+    assert to_units("ETH", "1") == 1_000_000_000
+    assert to_units("ETH", "0.000000001") == 1
+    # Sub-gwei (wei-level) precision is truncated
+    assert to_units("ETH", "0.0000000009") == 0
+
+def test_to_units_accepts_numbers_without_float_error():
+    assert to_units("SOL", 0.1) == 100_000_000
+    assert to_units("LTC", 10) == 10 * 10 ** 8
+
+@pytest.mark.parametrize("amount", ["abc", "", "1.2.3"])
+def test_to_units_rejects_garbage(amount):
+    with pytest.raises(ValueError):
+        to_units("SOL", amount)
+
+def test_format_units_strips_trailing_zeros():
+    assert format_units("SOL", 10 * 10 ** 9) == "10"
+    assert format_units("SOL", 150_000_000) == "0.15"
+    assert format_units("BTC", 100_000) == "0.001"
+    assert format_units("ETH", 1) == "0.000000001"
+    assert format_units("LTC", 0) == "0"
+
+def test_format_units_negative():
+    assert format_units("BTC", -1) == "-0.00000001"
+    assert format_units("BTC", to_units("BTC", "-0.5")) == "-0.5"
+    assert format_units("SOL", -10 * 10 ** 9) == "-10"
+
+def test_roundtrip():
+    for crypto in SCALE:
+        assert format_units(crypto, to_units(crypto, "1.05")) == "1.05"
+        assert format_units(crypto, to_units(crypto, "-1.05")) == "-1.05"
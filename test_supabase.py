@@ -1,23 +1,34 @@
-from supabase import create_client, Client
-from dotenv import load_dotenv
 import os
 
+import pytest
+from dotenv import load_dotenv
+
+# bot.py refuses to import without its .env, so skip cleanly instead
 load_dotenv()
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+if not all(os.getenv(name) for name in ("API_TOKEN", "SUPABASE_URL", "SUPABASE_KEY", "TATUM_API_KEY")):
+    pytest.skip("Supabase/Telegram/Tatum credentials not configured", allow_module_level=True)
+
+from bot import get_supabase
+
+# Telegram user ids are positive, so this row can never belong to a real user
+TEST_USER_ID = -12345
+
+@pytest.fixture(scope="session")
+def sb():
+    return get_supabase()
+
+def test_connection(sb):
+    response = sb.table("users").select("user_id").limit(1).execute()
+    assert isinstance(response.data, list)
 
-try:
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-    response = supabase.table("users").select("user_id").limit(1).execute()
-    print("Connected successfully!")
-    print("Users table data:", response.data)
-    # Insert a test user
-    supabase.table("users").insert({
-        "user_id": 12345,
-        "balances": {"SOL": 10.0, "LTC": 10.0, "TON": 10.0, "ETH": 10.0}
-    }).execute()
-    print("Inserted test user")
-    response = supabase.table("users").select("*").eq("user_id", 12345).execute()
-    print("Test user data:", response.data)
-except Exception as e:
-    print("Connection failed:", e)
\ No newline at end of file
+def test_insert_roundtrip(sb):
+    # PostgREST runs each request in its own transaction, so clean up explicitly
+    try:
+        sb.table("users").insert({
+            "user_id": TEST_USER_ID,
+            "balances": {"SOL": 10, "LTC": 10, "BTC": 10, "ETH": 10}
+        }).execute()
+        response = sb.table("users").select("user_id,balances").eq("user_id", TEST_USER_ID).execute()
+        assert response.data[0]["balances"]["SOL"] == 10
+    finally:
+        sb.table("users").delete().eq("user_id", TEST_USER_ID).execute()